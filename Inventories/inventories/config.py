@@ -2,15 +2,25 @@
 Using a configuration file in YAML format, so it can be reused by the plugin.
 An 'Ini' file with ConfigParser is more convenient but will keep the configuration files
 """
+import hashlib
 import os
-from yaml import safe_load
+import pickle
+from functools import lru_cache
+from typing import Any, Tuple
+from yaml import load
 
 try:
-    from yaml import CLoader as Loader, CDumper as Dumper
+    from yaml import CSafeLoader as SafeLoader
 except ImportError:
-    from yaml import Loader, Dumper
+    from yaml import SafeLoader
+
+"""
+Parsed configuration files are pickled here, so the YAML is not parsed again on every run
+"""
+CACHE_DIR = os.path.expanduser("~/.cache/nmap_inventory")
 
 
+@lru_cache(maxsize=8)
 def load_config(config_file: str = os.path.expanduser("~/.ansible/plugins/cliconf/nmap_inventory.yaml")):
     """
     Where to copy the configuration file:
@@ -20,9 +30,35 @@ def load_config(config_file: str = os.path.expanduser("~/.ansible/plugins/clicon
     '/home/josevnz/.ansible/plugins/cliconf', '/usr/share/ansible/plugins/cliconf'
     ]
     ```
+    The parsed configuration is cached on CACHE_DIR, and it is reused for as long as the size and
+    modification time of the configuration file do not change.
+    Results are also memoized on the current process, call load_config.cache_clear() to force a fresh read.
     :param config_file:
     :return:
     """
+    source = os.stat(config_file)
+    signature = (source.st_mtime_ns, source.st_size)
+    cache_file = os.path.join(
+        CACHE_DIR,
+        f"{hashlib.sha256(os.path.abspath(config_file).encode('utf-8')).hexdigest()}.pkl"
+    )
+    try:
+        with open(cache_file, 'rb') as cache:
+            cached_signature, data = pickle.load(cache)
+            if cached_signature == signature:
+                return data
+    except Exception:
+        pass  # Missing or unreadable cache, parse the YAML file instead
     with open(config_file, 'r') as stream:
-        data = safe_load(stream)
-        return data
+        data = load(stream, Loader=SafeLoader)
+    _save_cache(cache_file, (signature, data))
+    return data
+
+
+def _save_cache(cache_file: str, cached: Tuple[Tuple[int, int], Any]):
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'wb') as cache:
+            pickle.dump(cached, cache, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        pass  # Caching is best effort only
@@ -5,12 +5,31 @@ Jose Vicente Nunez (kodegeek.com@protonmail.com)
 
 import os.path
 from subprocess import CalledProcessError
+import asyncio
+import io
 import os
-import shlex
 import shutil
+import socket
 import subprocess
-from typing import List, Dict, Any
-from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Dict, Optional, Union, BinaryIO, Iterator, Tuple, Any
+
+try:
+    from lxml import etree as ElementTree
+    # libxml2 only reports the elements OutputParser cares about, skipping the rest in C
+    PULL_PARSER_OPTIONS = {'tag': ('nmaprun', 'host')}
+    # Same filter as OutputParser, compiled once and evaluated by libxml2 in a single call per host.
+    # Plain strings, so the results do not keep the parsed hosts alive
+    SSH_HOST_ADDRESS = ElementTree.XPath(
+        "self::host[status/@state='up'][ports/port[@portid='22']/state/@state='open']/address[1]/@addr",
+        smart_strings=False
+    )
+except ImportError:
+    from xml.etree import ElementTree
+    PULL_PARSER_OPTIONS = {}
+    SSH_HOST_ADDRESS = None
+
 # The imports below are the ones required for an Ansible plugin
 from ansible.errors import AnsibleParserError
 from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable, Constructable
@@ -20,13 +39,15 @@ DOCUMENTATION = r'''
     plugin_type: inventory
     short_description: Returns a dynamic host inventory from Nmap scan
     description: Returns a dynamic host inventory from Nmap scan, filter machines that can be accessed with SSH
+    extends_documentation_fragment:
+      - inventory_cache
     options:
       plugin:
           description: Name of the plugin
           required: true
           choices: ['nmap_plugin']
       address:
-        description: Address to scan, in Nmap supported format
+        description: Address to scan, in Nmap supported format. Ranges separated by spaces are scanned concurrently
         required: true
 '''
 
@@ -51,111 +72,221 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         try:
             self.plugin = self.get_option('plugin')
             self.address = self.get_option('address')
-            hosts_data = list(NmapRunner(self.address))
+            cache_key = self.get_cache_key(path)
+            # Only read the cache if Ansible allows it (no --flush-cache) and the user enabled it
+            use_cache = self.get_option('cache')
+            cache_needs_update = use_cache and not cache
+            hosts_data = None
+            if use_cache and cache:
+                try:
+                    hosts_data = self._cache[cache_key]
+                except KeyError:
+                    cache_needs_update = True
+            if hosts_data is None:
+                hosts_data = NmapRunner.scan_many(self.address.split())
             if not hosts_data:
                 raise AnsibleParserError("Unable to get data for Nmap scan!")
-            for host_data in hosts_data:
-                for name, address in host_data.items():
-                    self.inventory.add_host(name)
-                    self.inventory.set_variable(name, 'ip', address)
+            if cache_needs_update:
+                self._cache[cache_key] = hosts_data
+            for name, addresses in hosts_data.items():
+                self.inventory.add_host(name)
+                self.inventory.set_variable(name, 'ip', addresses[0])
         except KeyError as kerr:
             raise AnsibleParserError(f'Missing required option on the configuration file: {path}', kerr)
         except CalledProcessError as cpe:
             raise AnsibleParserError("There was an error while calling Nmap", cpe)
 
 
+"""
+Size of the chunks read from the Nmap report
+"""
+READ_CHUNK_SIZE = 65536
+
+
 class OutputParser:
-    def __init__(self, xml: str):
-        self.xml = xml
+    def __init__(self, xml: Union[bytes, BinaryIO]):
+        """
+        :param xml: Nmap XML report, either raw bytes or a binary file-like object (like a pipe)
+        """
+        self.xml = io.BytesIO(xml) if isinstance(xml, bytes) else xml
 
-    def get_addresses(self) -> List[Dict[str, str]]:
+    def get_addresses(self) -> List[str]:
         """
         Several things need to happen for an address to be included:
         1. Host is up
         2. Port is TCP 22
         3. Port status is open
         4. Uses IPv4
+        Host names are not part of the report (Nmap runs with -n), NmapRunner resolves them
+        :return: List of IP addresses
         """
         addresses = []
-        root = ElementTree.fromstring(self.xml)
-        for host in root.findall('host'):
-            name = None
-            for hostnames in host.findall('hostnames'):
-                for hostname in hostnames:
-                    name = hostname.attrib['name']
-                    break
-            if not name:
-                continue
-            is_up = True
-            for status in host.findall('status'):
-                if status.attrib['state'] == 'down':
-                    is_up = False
-                    break
-            if not is_up:
+        root = None
+        for event, element in self.__read_events():
+            if root is None:
+                root = element  # <nmaprun>, used to release the hosts already processed
+            if event != 'end' or element.tag != 'host':
                 continue
-            port_22_open = False
-            for ports in host.findall('ports'):
-                for port in ports.findall('port'):
-                    if port.attrib['portid'] == '22':
-                        for state in port.findall('state'):
-                            if state.attrib['state'] == "open":  # Up not the same as open, we want SSH access!
-                                port_22_open = True
-                                break
-            if not port_22_open:
-                continue
-            address = None
-            for address_data in host.findall('address'):
-                address = address_data.attrib['addr']
-                break
-            addresses.append({name: address})
+            address = OutputParser.__get_address(element)
+            if address:
+                addresses.append(address)
+            root.clear()
         return addresses
 
+    def __read_events(self) -> Iterator[Tuple[str, Any]]:
+        """
+        Feed the report to the parser in chunks, as they become available. read1 does not wait
+        for a full chunk, so hosts are processed while Nmap keeps writing to the pipe
+        """
+        parser = ElementTree.XMLPullParser(events=('start', 'end'), **PULL_PARSER_OPTIONS)
+        read = getattr(self.xml, 'read1', self.xml.read)
+        while chunk := read(READ_CHUNK_SIZE):
+            parser.feed(chunk)
+            yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    @staticmethod
+    def __get_address(host: ElementTree.Element) -> Optional[str]:
+        if SSH_HOST_ADDRESS is not None:
+            found = SSH_HOST_ADDRESS(host)
+            return found[0] if found else None
+        if host.find("status[@state='up']") is None:
+            return None
+        # Up not the same as open, we want SSH access!
+        if host.find("ports/port[@portid='22']/state[@state='open']") is None:
+            return None
+        address = host.find('address')
+        return address.get('addr') if address is not None else None
+
+
+"""
+Number of concurrent reverse DNS lookups
+"""
+DNS_WORKERS = 32
+
+
+@lru_cache(maxsize=None)
+def find_nmap() -> str:
+    """
+    Look for the Nmap binary only once, instead of scanning the PATH for every NmapRunner
+    """
+    found_nmap = shutil.which('nmap', mode=os.F_OK | os.X_OK)
+    if not found_nmap:
+        raise ValueError("Nmap binary is missing!")
+    return found_nmap
+
+
+def get_host_name(address: str) -> str:
+    """
+    Reverse DNS lookup of an address
+    :param address: IP address
+    :return: Host name, or the same address if it has no PTR record
+    """
+    try:
+        return socket.gethostbyaddr(address)[0]
+    except OSError:
+        return address
+
+
+def resolve_host_names(addresses: List[str]) -> Dict[str, List[str]]:
+    """
+    Resolve the host names in parallel, as the lookups spend their time waiting for the DNS server
+    and not for the CPU (Nmap is much slower doing this, as it resolves them one by one).
+    It is possible to have the same name for several addresses
+    :param addresses: IP addresses
+    :return: Dictionary of host names and their addresses
+    """
+    host_names = {}
+    with ThreadPoolExecutor(max_workers=DNS_WORKERS) as executor:
+        for name, address in zip(executor.map(get_host_name, addresses), addresses):
+            host_names.setdefault(name, []).append(address)
+    return host_names
+
 
 class NmapRunner:
 
     def __init__(self, hosts: str):
         self.nmap_report_file = None
-        found_nmap = shutil.which('nmap', mode=os.F_OK | os.X_OK)
-        if not found_nmap:
-            raise ValueError("Nmap binary is missing!")
-        self.nmap = found_nmap
+        self.nmap = find_nmap()
         self.hosts = hosts
 
-    def __iter__(self):
-        command = [self.nmap]
-        command.extend(__NMAP__FLAGS__)
-        command.append(self.hosts)
-        completed = subprocess.run(
+    def scan(self) -> Dict[str, List[str]]:
+        """
+        Run Nmap, parse the report and resolve the host names
+        :return: Dictionary of host names and their addresses
+        """
+        command = [self.nmap, *__NMAP__FLAGS__, self.hosts]
+        with subprocess.Popen(
             command,
-            capture_output=True,
-            shell=False,
-            check=True
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            shell=False
+        ) as process:
+            try:
+                # Parse the report while Nmap is still writing it
+                addresses = OutputParser(process.stdout).get_addresses()
+            finally:
+                process.stdout.close()
+                if process.wait() != 0:
+                    # A failed scan takes precedence over an incomplete report
+                    raise subprocess.CalledProcessError(process.returncode, command)
+        return resolve_host_names(addresses)
+
+    @staticmethod
+    def scan_many(host_specs: List[str]) -> Dict[str, List[str]]:
+        """
+        Scan several address ranges concurrently, with one Nmap process for each range.
+        Nmap spends most of the time waiting for the network, so the scans overlap nicely
+        :param host_specs: Address ranges, in Nmap supported format
+        :return: Same as NmapRunner.scan, with the results of all the ranges merged
+        """
+        if len(host_specs) == 1:
+            return NmapRunner(host_specs[0]).scan()
+        addresses = {}  # Used as an ordered set, ranges may overlap
+        for found_data in asyncio.run(NmapRunner.__gather(host_specs)):
+            if isinstance(found_data, Exception):
+                raise found_data
+            addresses.update(dict.fromkeys(found_data))
+        return resolve_host_names(list(addresses))
+
+    @staticmethod
+    async def __gather(host_specs: List[str]) -> List[Union[List[str], Exception]]:
+        # Let every scan finish, even if one of them fails, so no Nmap process is left behind
+        return await asyncio.gather(
+            *(NmapRunner(hosts).__scan_async() for hosts in host_specs),
+            return_exceptions=True
         )
-        completed.check_returncode()
-        out_par = OutputParser(completed.stdout.decode('utf-8'))
-        self.addresses = out_par.get_addresses()
-        return self
 
-    def __next__(self):
-        try:
-            return self.addresses.pop()
-        except IndexError:
-            raise StopIteration
+    async def __scan_async(self) -> List[str]:
+        command = [self.nmap, *__NMAP__FLAGS__, self.hosts]
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        stdout, _ = await process.communicate()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return OutputParser(stdout).get_addresses()
+
+    def __iter__(self):
+        return iter(self.scan())
 
 
 """
-Convert the args for proper usage on the Nmap CLI
-Also, do not use the -n flag. We need to resolve IP addresses to hostname, even if we sacrifice a little bit of speed
+Static Nmap CLI arguments, already split
+Use the -n flag, host names are resolved in parallel by resolve_host_names, which is much faster
 """
-NMAP_DEFAULT_FLAGS = {
-    '-p22': 'Port 22 scanning',
-    '-T4': 'Aggressive timing template',
-    '-PE': 'Enable this echo request behavior. Good for internal networks',
-    '--disable-arp-ping': 'No ARP or ND Ping',
-    '--max-hostgroup 50': 'Hostgroup (batch of hosts scanned concurrently) size',
-    '--min-parallelism 50': 'Number of probes that may be outstanding for a host group',
-    '--osscan-limit': 'Limit OS detection to promising targets',
-    '--max-os-tries 1': 'Maximum number of OS detection tries against a target',
-    '-oX -': 'Send XML output to STDOUT, avoid creating a temp file'
-}
-__NMAP__FLAGS__ = shlex.split(" ".join(NMAP_DEFAULT_FLAGS.keys()))
+__NMAP__FLAGS__ = (
+    '-n',  # No DNS resolution
+    '-p22',  # Port 22 scanning
+    '-T4',  # Aggressive timing template
+    '-PE',  # Enable this echo request behavior. Good for internal networks
+    '--disable-arp-ping',  # No ARP or ND Ping
+    '--max-hostgroup', '50',  # Hostgroup (batch of hosts scanned concurrently) size
+    '--min-parallelism', '50',  # Number of probes that may be outstanding for a host group
+    '--osscan-limit',  # Limit OS detection to promising targets
+    '--max-os-tries', '1',  # Maximum number of OS detection tries against a target
+    '-oX', '-'  # Send XML output to STDOUT, avoid creating a temp file
+)
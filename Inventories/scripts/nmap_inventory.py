@@ -6,15 +6,26 @@
 # Author
 Jose Vicente Nunez Zuleta (kodegeek.com@protonmail.com)
 """
-import json
 import argparse
+from typing import Any
+
+try:
+    import orjson
+
+    def dumps(data: Any, pretty: bool = False) -> str:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0).decode('utf-8')
+except ImportError:
+    import json
+
+    def dumps(data: Any, pretty: bool = False) -> str:
+        return json.dumps(data, indent=2 if pretty else None)
 
 from inventories.nmap import NmapRunner
 from inventories.config import load_config
 
 
 def get_empty_vars():
-    return json.dumps({})
+    return dumps({})
 
 
 def get_list(search_address: str, pretty=False) -> str:
@@ -23,20 +34,12 @@ def get_list(search_address: str, pretty=False) -> str:
     Ungrouped at least contains all the names found
     IP addresses are added as vars in the __meta tag, for efficiency as mentioned in the Ansible documentation.
     Note than we can add logic here to put machines in custom groups, will keep it simple for now.
-    :param search_address: Results of the scan with NMap
+    :param search_address: Addresses to scan, in Nmap format. Ranges separated by spaces are scanned concurrently
     :param pretty: Indentation
     :return: JSON string
     """
-    found_data = list(NmapRunner(search_address))
-    hostvars = {}
-    ungrouped = []
-    for host_data in found_data:
-        for name, address in host_data.items():
-            if name not in ungrouped:
-                ungrouped.append(name)
-            if name not in hostvars:
-                hostvars[name] = {'ip': []}
-            hostvars[name]['ip'].append(address)
+    found_data = NmapRunner.scan_many(search_address.split())
+    hostvars = {name: {'ip': addresses} for name, addresses in found_data.items()}
     data = {
         '_meta': {
           'hostvars': hostvars
@@ -47,10 +50,10 @@ def get_list(search_address: str, pretty=False) -> str:
             ]
         },
         'ungrouped': {
-            'hosts': ungrouped
+            'hosts': sorted(found_data)
         }
     }
-    return json.dumps(data, indent=pretty)
+    return dumps(data, pretty)
 
 
 if __name__ == '__main__':
@@ -1,11 +1,17 @@
 """
 Unit tests for Nmap host capture
 """
+import os
+import shutil
+import socket
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from unittest import TestCase
+from unittest.mock import patch
 
+from inventories import config
 from inventories.config import load_config
-from inventories.nmap import OutputParser, NmapRunner
+from inventories.nmap import OutputParser, NmapRunner, resolve_host_names
 
 BASEDIR = Path(__file__).parent
 
@@ -13,16 +19,47 @@ BASEDIR = Path(__file__).parent
 class TestOutputParser(TestCase):
 
     def test_get_addresses(self):
-        with open(BASEDIR.joinpath("home_scan.xml"), 'rt') as home_scan_file:
+        with open(BASEDIR.joinpath("home_scan.xml"), 'rb') as home_scan_file:
             out_p = OutputParser(home_scan_file.read())
             self.assertIsNotNone(out_p)
             hosts_data = out_p.get_addresses()
             self.assertIsNotNone(hosts_data)
-            for host_data in hosts_data:
-                for name, address in host_data.items():
-                    self.assertIsNotNone(name)
-                    self.assertIn(address, ['192.168.1.11', '192.168.1.16', '192.168.1.25', '192.168.1.26'])
-                    print(address)
+            self.assertEqual(['192.168.1.11', '192.168.1.16', '192.168.1.25', '192.168.1.26'], hosts_data)
+            for address in hosts_data:
+                print(address)
+
+    def test_get_addresses_from_stream(self):
+        with open(BASEDIR.joinpath("home_scan.xml"), 'rb') as home_scan_file:
+            expected = OutputParser(home_scan_file.read()).get_addresses()
+            home_scan_file.seek(0)
+            self.assertEqual(expected, OutputParser(home_scan_file).get_addresses())
+
+    def test_get_addresses_small_chunks(self):
+        with open(BASEDIR.joinpath("home_scan.xml"), 'rb') as home_scan_file:
+            report = home_scan_file.read()
+        with patch('inventories.nmap.READ_CHUNK_SIZE', 100):
+            self.assertEqual(
+                ['192.168.1.11', '192.168.1.16', '192.168.1.25', '192.168.1.26'],
+                OutputParser(report).get_addresses()
+            )
+
+
+class TestResolveHostNames(TestCase):
+
+    def test_resolve_host_names(self):
+        ptr_records = {'192.168.1.25': 'dmaf5.home', '192.168.1.26': 'dmaf5.home'}
+
+        def gethostbyaddr(address: str):
+            if address not in ptr_records:
+                raise socket.herror(1, 'Unknown host')
+            return ptr_records[address], [], [address]
+
+        with patch('inventories.nmap.socket.gethostbyaddr', side_effect=gethostbyaddr):
+            host_names = resolve_host_names(['192.168.1.25', '192.168.1.11', '192.168.1.26'])
+        self.assertEqual(
+            {'dmaf5.home': ['192.168.1.25', '192.168.1.26'], '192.168.1.11': ['192.168.1.11']},
+            host_names
+        )
 
 
 class TestNmapRunner(TestCase):
@@ -30,8 +67,15 @@ class TestNmapRunner(TestCase):
     This test will fail if you are not running SSH at localhost.
     """
 
-    def test_iter(self):
-        addresses = list(NmapRunner("127.0.01/32"))
+    def test_scan(self):
+        addresses = NmapRunner("127.0.01/32").scan()
+        self.assertIsNotNone(addresses)
+        self.assertTrue(len(addresses) > 0)
+        for address in addresses:
+            print(address)
+
+    def test_scan_many(self):
+        addresses = NmapRunner.scan_many(["127.0.0.1/32", "127.0.0.2/32"])
         self.assertIsNotNone(addresses)
         self.assertTrue(len(addresses) > 0)
         for address in addresses:
@@ -40,6 +84,15 @@ class TestNmapRunner(TestCase):
 
 class TestConfig(TestCase):
 
+    def setUp(self):
+        self.cache_dir = TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        cache_patch = patch.object(config, 'CACHE_DIR', self.cache_dir.name)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+        load_config.cache_clear()
+        self.addCleanup(load_config.cache_clear)
+
     def test_load_config(self):
         config = load_config(str(BASEDIR.joinpath('nmap_plugin_inventory.yaml')))
         self.assertIsNotNone(config)
@@ -47,3 +100,16 @@ class TestConfig(TestCase):
         self.assertIsNotNone(config['plugin'])
         self.assertIn('address', config)
         self.assertIsNotNone(config['address'])
+
+    def test_load_config_cache(self):
+        config_file = Path(self.cache_dir.name).joinpath('inventory.yaml')
+        shutil.copy(BASEDIR.joinpath('nmap_plugin_inventory.yaml'), config_file)
+        config_data = load_config(str(config_file))
+        self.assertTrue(any(name.endswith('.pkl') for name in os.listdir(self.cache_dir.name)))
+        self.assertIs(config_data, load_config(str(config_file)))
+        load_config.cache_clear()
+        self.assertEqual(config_data, load_config(str(config_file)))
+        with open(config_file, 'a') as config_stream:
+            config_stream.write("\nstrict: False\n")
+        load_config.cache_clear()
+        self.assertIn('strict', load_config(str(config_file)))